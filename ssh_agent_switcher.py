@@ -8,14 +8,57 @@ import argparse
 import textwrap
 import shutil
 import errno
+import fcntl
+import glob
 import logging
 import os
+import queue
+import selectors
 import signal
 import socket
 import stat
+import struct
 import sys
 import threading
-from typing import Optional, List, Tuple
+import time
+from typing import Callable, Optional, List, Tuple
+
+
+log = logging.getLogger(__name__)
+
+# Size of the kernel send and receive buffers of the proxied sockets.  The kernel caps this
+# at net.core.wmem_max and net.core.rmem_max.
+SOCKET_BUF_SIZE = 256 * 1024
+
+# How long, in seconds, to keep reusing a discovered agent socket before scanning again.
+AGENT_CACHE_TTL = 5.0
+
+# Whether the kernel can move data between the proxied sockets through pipes by itself.
+# Setting SSH_AGENT_SWITCHER_NO_SPLICE in the environment forces copying through buffers
+# instead, which is how the tests exercise that path on systems that can splice.
+HAVE_SPLICE = hasattr(os, "splice") and not os.environ.get("SSH_AGENT_SWITCHER_NO_SPLICE")
+
+# Capacity of the pipes used to splice data between the proxied sockets, and the flags to use.
+PIPE_SIZE = 64 * 1024
+SPLICE_FLAGS = getattr(os, "SPLICE_F_MOVE", 0) | getattr(os, "SPLICE_F_NONBLOCK", 0)
+
+# Size of the buffers used to copy data between the proxied sockets when splicing is not
+# possible.  Reads are never larger than this but messages that do not fit are simply
+# forwarded in multiple steps.  This matches PIPE_SIZE so that large keys and certificates
+# take as few steps as they do when splicing.
+BUF_SIZE = 64 * 1024
+
+# How long, in seconds, to let open connections finish their work after being asked to shut
+# down before closing them forcibly.
+SHUTDOWN_GRACE_PERIOD = 5.0
+
+# How long, in seconds, to stop accepting connections after running out of file descriptors,
+# unless a connection closes and frees some first.
+ACCEPT_BACKOFF = 1.0
+
+# Maximum number of idle buffers kept around for reuse.  This covers the concurrent sessions
+# one usually has open without holding on to the memory of rare bursts.
+BUFFER_POOL_CAPACITY = 32
 
 
 def default_socket_path() -> str:
@@ -26,208 +69,701 @@ def default_socket_path() -> str:
     return f"/tmp/ssh-agent.{user}"
 
 
-def find_agent_socket_subdir(dir_path: str) -> Optional[socket.socket]:
+def tune_socket(sock: socket.socket) -> None:
     """
-    Scans the contents of "dir", which should point to a session directory created by sshd,
-    looks for a valid "agent.*" socket, opens it, and returns the connection to the agent.
+    Sizes the kernel buffers of "sock" explicitly so that they do not start out small and
+    force agent messages through multiple reads and writes.  This is only an optimization, so
+    failures are ignored.
+    """
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUF_SIZE)
+        except OSError as err:
+            log.info("Cannot set socket buffer size: %s", err)
+
+
+# The agent socket found by the most recent scan and when that scan happened.
+agent_cache = {"path": None, "ts": 0.0}
+agent_cache_lock = threading.Lock()
+
+
+def remember_agent(path: str) -> None:
+    """Records "path" as the agent socket to reuse for the next AGENT_CACHE_TTL seconds."""
+    with agent_cache_lock:
+        agent_cache["path"] = path
+        agent_cache["ts"] = time.monotonic()
+
+
+def forget_agent(path: str) -> None:
+    """Stops reusing "path", unless another scan has replaced it already."""
+    with agent_cache_lock:
+        if agent_cache["path"] == path:
+            agent_cache["path"] = None
+
 
-    This tries all possible files in search for a socket and only returns an error if no valid
-    and alive candidate can be found.
+def open_cached_agent(our_uid: int) -> Optional[socket.socket]:
     """
+    Opens the agent socket found by a recent scan, if it is still a socket owned by "our_uid",
+    so that back-to-back connections do not have to scan the agents directory again.
+    """
+    with agent_cache_lock:
+        path = agent_cache["path"]
+        if path is None or time.monotonic() - agent_cache["ts"] >= AGENT_CACHE_TTL:
+            return None
+
     try:
-        entries = os.listdir(dir_path)
+        file_info = os.stat(path)
     except OSError as err:
+        log.info("Forgetting %s: stat failed: %s", path, err)
+        forget_agent(path)
         return None
 
-    for entry in entries:
-        path = os.path.join(dir_path, entry)
+    if not stat.S_ISSOCK(file_info.st_mode) or file_info.st_uid != our_uid:
+        log.info("Forgetting %s: not a socket owned by the current user", path)
+        forget_agent(path)
+        return None
 
-        if not entry.startswith("agent."):
-            logging.info(f"Ignoring {path}: does not start with 'agent.'")
-            continue
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except socket.error as err:
+        conn.close()
+        log.info("Forgetting %s: open failed: %s", path, err)
+        forget_agent(path)
+        return None
 
-        try:
-            file_info = os.stat(path)
-        except OSError as err:
-            logging.info(f"Ignoring {path}: stat failed: {err}")
-            continue
+    tune_socket(conn)
+    log.info("Successfully opened SSH agent at %s", path)
+    return conn
 
-        # Check if it's a socket
-        if not stat.S_ISSOCK(file_info.st_mode):
-            logging.info(f"Ignoring {path}: not a socket")
-            continue
 
-        try:
+def agent_uid(conn: socket.socket, path: str) -> int:
+    """
+    Returns the user that serves the agent connection "conn", opened at "path".  This asks the
+    kernel for the credentials of the peer process on Linux, and falls back to the owner of the
+    session directory that contains the socket elsewhere.
+    """
+    if sys.platform.startswith("linux"):
+        # Linux's struct ucred holds a signed pid_t followed by an unsigned uid_t and gid_t.
+        # Other systems that define SO_PEERCRED, such as OpenBSD, order the fields differently.
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("iII"))
+        _pid, uid, _gid = struct.unpack("iII", creds)
+        return uid
+    return os.stat(os.path.dirname(path)).st_uid
+
+
+def make_agent_finder(dir_path: str) -> Callable[[], Optional[socket.socket]]:
+    """
+    Returns a function that scans the contents of "dir", which should point to the directory
+    where sshd places the session directories for forwarded agents, looks for a valid
+    connection to an agent, opens the agent's socket, and returns the connection to the agent.
+
+    sshd names session directories "ssh-*" and the agent sockets in them "agent.*", so a single
+    glob enumerates all candidates without looking at unrelated files.  The returned function
+    tries all of them in search for a socket and only returns an error if no valid and alive
+    candidate can be found.  The agent found by a scan is reused without scanning again for the
+    following AGENT_CACHE_TTL seconds as long as it remains valid.
+
+    Neither the directory nor our user change for the life of the daemon, so the glob pattern
+    and our uid are computed here once instead of on every connection.
+    """
+    pattern = os.path.join(glob.escape(dir_path), "ssh-*", "agent.*")
+    our_uid = os.getuid()
+
+    def find_agent_socket() -> Optional[socket.socket]:
+        agent = open_cached_agent(our_uid)
+        if agent is not None:
+            return agent
+
+        # glob only descends into directories, which it tells apart using the file types
+        # returned by the directory listing, and we do not stat candidates to check that they
+        # are sockets either: connecting to anything else fails anyway.  The same goes for the
+        # session directories of other users: sshd creates them private, so glob cannot even
+        # list them and connecting to their sockets fails.  Ownership is verified once, on the
+        # connection itself.
+        #
+        # Rejected candidates are only worth logging when debugging, so check whether that is
+        # the case once per scan instead of calling into the logger for every candidate.
+        #
+        # Candidates are tried sorted by session directory and then by socket name, like the Go
+        # version does, so that the same agent wins every scan when there are several of them.
+        # Splitting the paths keeps "ssh-a" ahead of "ssh-a-b", as comparing names would.
+        debug = log.isEnabledFor(logging.DEBUG)
+        for path in sorted(glob.iglob(pattern), key=os.path.split):
             conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-            conn.connect(path)
-            logging.info(f"Successfully opened SSH agent at {path}")
+            try:
+                conn.connect(path)
+            except socket.error as err:
+                conn.close()
+                if debug:
+                    if err.errno in (errno.EACCES, errno.EPERM):
+                        log.debug(
+                            "Ignoring %s: not accessible by current user %s", path, our_uid)
+                    else:
+                        log.debug("Ignoring %s: open failed: %s", path, err)
+                continue
+
+            # Make sure that we do not forward requests, which may carry private keys, to a
+            # socket that another user left in a directory we can read.
+            try:
+                uid = agent_uid(conn, path)
+            except OSError as err:
+                conn.close()
+                if debug:
+                    log.debug("Ignoring %s: cannot determine owner: %s", path, err)
+                continue
+            if uid != our_uid:
+                conn.close()
+                if debug:
+                    log.debug(
+                        "Ignoring %s: owner %s is not current user %s", path, uid, our_uid)
+                continue
+
+            tune_socket(conn)
+            log.info("Successfully opened SSH agent at %s", path)
+            remember_agent(path)
             return conn
-        except socket.error as err:
-            logging.info(f"Ignoring {path}: open failed: {err}")
-            continue
 
-    return None
+        return None
 
+    return find_agent_socket
 
-def find_agent_socket(dir_path: str) -> Optional[socket.socket]:
-    """
-    Scans the contents of "dir", which should point to the directory where
-    sshd places the session directories for forwarded agents, looks for a valid connection to
-    an agent, opens the agent's socket, and returns the connection to the agent.
 
-    This tries all possible directories in search for a socket and only returns an error if
-    no valid and alive candidate can be found.
+class BufferPool:
+    """
+    Thread-safe pool of buffers of a fixed size, so that new connections reuse the buffers
+    left behind by closed ones instead of allocating their own.
     """
-    try:
-        entries = os.listdir(dir_path)
-    except OSError as err:
-        return None
 
-    # The sorting is unnecessary but it helps with testing certain conditions.
-    entries.sort()
+    def __init__(self, size: int, capacity: int) -> None:
+        self.size = size
+        self.free: "queue.LifoQueue[bytearray]" = queue.LifoQueue(maxsize=capacity)
 
-    our_uid = os.getuid()
-    for entry in entries:
-        path = os.path.join(dir_path, entry)
+    def acquire(self) -> bytearray:
+        """Returns an idle buffer from the pool, or a new one if there is none."""
+        try:
+            return self.free.get_nowait()
+        except queue.Empty:
+            return bytearray(self.size)
 
-        if not os.path.isdir(path):
-            logging.info(f"Ignoring {path}: not a directory")
-            continue
+    def release(self, buf: bytearray) -> None:
+        """Returns "buf" to the pool, or drops it if it does not fit in the pool."""
+        if len(buf) != self.size:
+            return
+        try:
+            self.free.put_nowait(buf)
+        except queue.Full:
+            pass
 
-        if not entry.startswith("ssh-"):
-            logging.info(f"Ignoring {path}: does not start with 'ssh-'")
-            continue
 
-        try:
-            file_info = os.stat(path)
-        except OSError as err:
-            logging.info(f"Ignoring {path}: stat failed: {err}")
-            continue
+buffer_pool = BufferPool(BUF_SIZE, BUFFER_POOL_CAPACITY)
 
-        # This check is not strictly necessary: if we found sshd sockets owned by other users, we
-        # would simply fail to open them later anyway.
-        if file_info.st_uid != our_uid:
-            logging.info(f"Ignoring {path}: owner {file_info.st_uid} is not current user {our_uid}")
-            continue
 
-        agent = find_agent_socket_subdir(path)
-        if agent is not None:
-            return agent
-        logging.info(f"Ignoring {path}: no socket in directory")
+class Endpoint:
+    """
+    One side of a proxied connection as tracked by the event loop: the socket itself, the
+    endpoint on the other side of the connection, and the data read from that other endpoint
+    that still has to be written to this one.
+
+    That data normally sits in a pipe so that the kernel can splice it from one socket to the
+    other without copying it through user space.  If splicing is not possible, the peer reads
+    directly into this endpoint's buffer and the data waits there, between "start" and "end".
+
+    "eof" records that this endpoint will not send anything else, and "shut" that we have
+    passed on the peer's EOF to this endpoint by shutting down writes to it.  Endpoints that
+    "answer_requests" are owed that EOF only once they have started replying to the last data
+    they received, which "awaiting_reply" tracks.
+    """
+
+    def __init__(self, sock: socket.socket, name: str) -> None:
+        self.sock = sock
+        self.name = name
+        self.peer: Optional["Endpoint"] = None
+        self.pipe: Optional[Tuple[int, int]] = None
+        self.piped = 0
+        self.buf: Optional[memoryview] = None
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        self.shut = False
+        self.answers_requests = False
+        self.awaiting_reply = False
+        self.events = 0
+
+        if HAVE_SPLICE:
+            try:
+                self.pipe = os.pipe()
+            except OSError as err:
+                # Most likely we are out of file descriptors.  Copying needs none, so keep
+                # serving the connection that way rather than dropping it.
+                log.info("Cannot create pipe for %s, copying instead: %s", name, err)
+        if self.pipe is not None:
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+            except (AttributeError, OSError):
+                pass  # The default capacity works too, only with more system calls.
+        else:
+            self.buf = memoryview(buffer_pool.acquire())
+
+    def has_pending(self) -> bool:
+        """Returns whether there is data waiting to be written to this endpoint."""
+        return self.piped > 0 or self.start < self.end
+
+    def stop_splicing(self) -> None:
+        """Moves any data left in the pipe to a buffer and stops using the pipe."""
+        pipe_r, pipe_w = self.pipe
+        data = bytearray()
+        while len(data) < self.piped:
+            data += os.read(pipe_r, self.piped - len(data))
+        os.close(pipe_r)
+        os.close(pipe_w)
+        self.pipe = None
+        self.piped = 0
+
+        if len(data) > BUF_SIZE:
+            self.buf = memoryview(data)
+        else:
+            self.buf = memoryview(buffer_pool.acquire())
+            self.buf[:len(data)] = data
+        self.start = 0
+        self.end = len(data)
+
+    def close(self) -> None:
+        """Closes the socket and the pipe, if any, and returns the buffer, if any, to the pool."""
+        self.sock.close()
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+        if self.buf is not None:
+            buf = self.buf.obj
+            self.buf.release()
+            self.buf = None
+            buffer_pool.release(buf)
+
+
+def update_events(sel: selectors.BaseSelector, endpoint: Endpoint) -> None:
+    """
+    Registers interest in the events that "endpoint" can make progress on: reading only until
+    EOF and when its peer has nothing left to write (so that a slow reader throttles a fast
+    writer), and writing only when there is something pending.
+    """
+    events = 0
+    if not endpoint.eof and not endpoint.peer.has_pending():
+        events |= selectors.EVENT_READ
+    if endpoint.has_pending():
+        events |= selectors.EVENT_WRITE
+
+    if events == endpoint.events:
+        return
+    if endpoint.events == 0:
+        sel.register(endpoint.sock, events, endpoint)
+    elif events == 0:
+        sel.unregister(endpoint.sock)
+    else:
+        sel.modify(endpoint.sock, events, endpoint)
+    endpoint.events = events
+
+
+def write_pending(endpoint: Endpoint) -> Optional[Exception]:
+    """Writes as much of the data pending for "endpoint" as it accepts without blocking."""
+    try:
+        if endpoint.piped:
+            try:
+                endpoint.piped -= os.splice(
+                    endpoint.pipe[0], endpoint.sock.fileno(), endpoint.piped, flags=SPLICE_FLAGS)
+            except OSError as err:
+                if err.errno != errno.EINVAL:
+                    raise
+                log.info("Cannot splice to %s, copying instead: %s", endpoint.name, err)
+                endpoint.stop_splicing()
+
+        if endpoint.start < endpoint.end:
+            endpoint.start += endpoint.sock.send(endpoint.buf[endpoint.start:endpoint.end])
+    except BlockingIOError:
+        pass
+    except socket.error as err:
+        return Exception(f"write to {endpoint.name} failed: {err}")
 
     return None
 
 
-def proxy_connection(client: socket.socket, agent: socket.socket) -> Optional[Exception]:
+def forward(endpoint: Endpoint) -> Tuple[bool, Optional[Exception]]:
     """
-    Forwards all request from the client to the agent, and all responses from
-    the agent to the client.
+    Reads whatever "endpoint" has available and writes it to its peer.
+
+    The write happens right away instead of waiting for the selector to report the peer as
+    writable: the peer is almost always ready, so this saves a round trip through the selector
+    (and its system calls) for every message.  Only what the peer did not accept is left
+    pending.
+
+    Reaching EOF only marks "endpoint" as such: the other direction keeps going so that a client
+    that half-closes its connection after sending a request still gets the response.
+
+    Returns whether the connection must be torn down and, if due to a failure, the reason.
     """
-    # The buffer needs to be large enough to handle any one read or write by the client or
-    # the agent. Otherwise bad things will happen.
-    buf_size = 4096
+    peer = endpoint.peer
 
     try:
-        while True:
+        if peer.pipe is not None:
             try:
-                # Read from client
-                data = client.recv(buf_size)
-                if not data:  # EOF
-                    break
+                n = os.splice(endpoint.sock.fileno(), peer.pipe[1], PIPE_SIZE, flags=SPLICE_FLAGS)
+            except OSError as err:
+                if err.errno != errno.EINVAL:
+                    raise
+                log.info("Cannot splice from %s, copying instead: %s", endpoint.name, err)
+                peer.stop_splicing()
+
+        if peer.pipe is None:
+            # We only read when the peer has nothing pending, so its whole buffer is free.
+            n = endpoint.sock.recv_into(peer.buf)
+    except BlockingIOError:
+        return False, None
+    except socket.error as err:
+        if err.errno == errno.ECONNRESET:
+            # Connection reset by peer - not an error
+            return True, None
+        return True, Exception(f"read from {endpoint.name} failed: {err}")
+
+    if not n:  # EOF
+        endpoint.eof = True
+        return False, None
+
+    endpoint.awaiting_reply = False
+    peer.awaiting_reply = True
+
+    if peer.pipe is not None:
+        peer.piped += n
+    else:
+        peer.start = 0
+        peer.end = n
 
-                # Write to agent
-                try:
-                    agent.sendall(data)
-                except socket.error as err:
-                    return Exception(f"write to agent failed: {err}")
+    err = write_pending(peer)
+    return err is not None, err
 
-                # Read from agent
-                try:
-                    response = agent.recv(buf_size)
-                    if not response:
-                        break
-                except socket.error as err:
-                    return Exception(f"read from agent failed: {err}")
 
-                # Write to client
-                try:
-                    client.sendall(response)
-                except socket.error as err:
-                    return Exception(f"write to client failed: {err}")
-                
-            except socket.error as err:
-                if err.errno == errno.ECONNRESET:
-                    # Connection reset by peer - not an error
-                    break
-                return Exception(f"read from client failed: {err}")
-    except Exception as err:
-        return err
+def finish_writes(endpoint: Endpoint) -> None:
+    """
+    Shuts down writes to "endpoint" once its peer has reached EOF and everything the peer sent
+    has been delivered, so that "endpoint" sees the EOF as well.
+
+    An agent that answers requests is told about the EOF only after it has started replying to
+    the last request (or has gone away), because ssh-agent drops pending replies as soon as it
+    sees its client go away.
+    """
+    if endpoint.shut or not endpoint.peer.eof or endpoint.has_pending():
+        return
+    if endpoint.answers_requests and endpoint.awaiting_reply and not endpoint.eof:
+        return
+    try:
+        endpoint.sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass  # The endpoint is gone already, which reading from it will tell us about.
+    endpoint.shut = True
 
-    return None
 
+def proxy_connection(
+    sel: selectors.BaseSelector, endpoint: Endpoint, mask: int
+) -> Tuple[bool, Optional[Exception]]:
+    """
+    Forwards requests from the client to the agent, and responses from the agent to the client,
+    as far as "endpoint" allows without blocking given the events in "mask".
+
+    Returns whether the connection is done and, if it terminated abnormally, the reason.  The
+    connection is done once both directions have reached EOF and delivered all their data.
+    """
+    peer = endpoint.peer
+
+    if mask & selectors.EVENT_WRITE:
+        err = write_pending(endpoint)
+        if err:
+            return True, err
+
+    if mask & selectors.EVENT_READ and not peer.has_pending():
+        done, err = forward(endpoint)
+        if done:
+            return True, err
 
-def handle_connection(client: socket.socket, agents_dir: str) -> None:
+    finish_writes(endpoint)
+    finish_writes(peer)
+    if endpoint.shut and peer.shut:
+        return True, None
+
+    update_events(sel, endpoint)
+    update_events(sel, peer)
+    return False, None
+
+
+def handle_connection(
+    sel: selectors.BaseSelector, client: socket.socket, agent: Optional[socket.socket]
+) -> Optional[Endpoint]:
     """
-    Receives a connection from the client, looks for an sshd serving an agent,
-    and proxies the connection to it.
+    Receives a connection from the client along with the agent found for it, if any,
+    and starts proxying the connection to it.
+
+    Returns the client side of the proxied connection, or None if there is nothing to proxy.
     """
-    logging.info("Accepted client connection")
-    
+    if agent is None:
+        log.info("Dropping connection: agent not found")
+        client.close()
+        log.info("Closing client connection")
+        return None
+
+    client_endpoint = None
     try:
-        agent = find_agent_socket(agents_dir)
-        if agent is None:
-            logging.info("Dropping connection: agent not found")
+        client.setblocking(False)
+        agent.setblocking(False)
+
+        client_endpoint = Endpoint(client, "client")
+        agent_endpoint = Endpoint(agent, "agent")
+    except Exception as err:
+        log.info("Dropping connection: %s", err)
+        if client_endpoint is not None:
+            client_endpoint.close()
+        else:
             client.close()
-            return
+        agent.close()
+        log.info("Closing client connection")
+        return None
+    agent_endpoint.answers_requests = True
+    client_endpoint.peer = agent_endpoint
+    agent_endpoint.peer = client_endpoint
 
-        try:
-            err = proxy_connection(client, agent)
-            if err:
-                logging.info(f"Dropping connection: {err}")
-        finally:
-            agent.close()
-            
-    finally:
-        client.close()
-        logging.info("Closing client connection")
+    update_events(sel, client_endpoint)
+    update_events(sel, agent_endpoint)
+    return client_endpoint
+
+
+def close_connection(
+    sel: selectors.BaseSelector, endpoint: Endpoint, err: Optional[Exception]
+) -> None:
+    """Stops proxying the connection that "endpoint" belongs to and closes both of its sides."""
+    if err:
+        log.info("Dropping connection: %s", err)
+
+    for side in (endpoint, endpoint.peer):
+        if side.events:
+            sel.unregister(side.sock)
+            side.events = 0
+        side.close()
+
+    log.info("Closing client connection")
+
+
+# Set when a signal asks us to exit.  The event loop notices and shuts down gracefully.
+shutdown_requested = threading.Event()
+
+# Set once the socket we listen on is deleted.  Another daemon may bind the same path right
+# after that, so we must not delete the path again.
+socket_deleted = threading.Event()
 
 
 def setup_signals(socket_path: str) -> None:
     """
-    Installs signal handlers to clean up files and ignores signals that we don't want
-    to cause us to exit.
+    Installs signal handlers to request a graceful shutdown and ignores signals that we don't
+    want to cause us to exit.  A second request exits right away, deleting "socket_path" if
+    the event loop has not done so yet.
     """
     # Prevent terminal disconnects from killing this process if started in the background.
     signal.signal(signal.SIGHUP, signal.SIG_IGN)
 
-    # Clean up the socket we create on exit.
-    def cleanup_handler(signum, frame):
-        logging.info(f"Shutting down due to signal and deleting {socket_path}")
-        try:
-            os.unlink(socket_path)
-        except OSError:
-            pass
-        sys.exit(1)
+    # Exiting right from the handler could interrupt a transfer halfway through, so only record
+    # the request and let the event loop clean up the socket we create once it is safe to do so.
+    def shutdown_handler(signum, frame):
+        if not shutdown_requested.is_set():
+            shutdown_requested.set()
+            return
+
+        log.info("Exiting immediately due to repeated signal")
+        if not socket_deleted.is_set():
+            socket_deleted.set()
+            log.info("Deleting %s", socket_path)
+            try:
+                os.unlink(socket_path)
+            except OSError:
+                pass
+        os._exit(1)
 
-    signal.signal(signal.SIGINT, cleanup_handler)
-    signal.signal(signal.SIGTERM, cleanup_handler)
+    signal.signal(signal.SIGINT, shutdown_handler)
+    signal.signal(signal.SIGTERM, shutdown_handler)
 
 
-def connection_handler_thread(client: socket.socket, agents_dir: str) -> None:
-    """Thread function to handle a client connection."""
-    handle_connection(client, agents_dir)
+def serve(
+    server: socket.socket, socket_path: str, find_agent: Callable[[], Optional[socket.socket]]
+) -> None:
+    """
+    Runs the event loop that accepts connections on "server", which listens on "socket_path",
+    and proxies them to the agents that "find_agent" opens.
+
+    Agent discovery scans directories and connects to sockets, both of which block, so it runs
+    on a small pool of worker threads.  The workers hand their results back to the event loop
+    through a queue and wake it up by writing to a socket pair.
+
+    Signals wake up the event loop through a pipe as well.  Once a shutdown is requested, this
+    stops accepting connections, deletes "socket_path", and waits up to SHUTDOWN_GRACE_PERIOD
+    seconds for the connections in flight to finish.  It returns if they do, and otherwise
+    closes them and exits the process right away.
+    """
+    sel = selectors.DefaultSelector()
+    pending = queue.SimpleQueue()
+    found = queue.SimpleQueue()
+    wakeup_r, wakeup_w = socket.socketpair()
+    wakeup_r.setblocking(False)
+    wakeup_w.setblocking(False)
+
+    def look_up_agents() -> None:
+        while True:
+            client = pending.get()
+            try:
+                result = find_agent()
+            except Exception as err:
+                result = err
+            found.put((client, result))
+            try:
+                wakeup_w.send(b"\0")
+            except BlockingIOError:
+                pass  # The event loop already has a wakeup pending.
+            except OSError:
+                pass  # The event loop is gone because we are shutting down.
+
+    # The workers are daemon threads so that a lookup stuck connecting to a wedged agent cannot
+    # keep the process alive once we are done.
+    for _ in range(4):
+        threading.Thread(target=look_up_agents, name="agent-lookup", daemon=True).start()
+
+    signal_r, signal_w = os.pipe()
+    os.set_blocking(signal_r, False)
+    os.set_blocking(signal_w, False)
+    old_wakeup_fd = signal.set_wakeup_fd(signal_w)
+
+    server.setblocking(False)
+    sel.register(server, selectors.EVENT_READ, server)
+    sel.register(wakeup_r, selectors.EVENT_READ, wakeup_r)
+    sel.register(signal_r, selectors.EVENT_READ, signal_r)
+
+    # The client side of every connection being proxied, and the number of clients waiting for
+    # an agent lookup to finish.
+    connections = set()
+    lookups = 0
+    deadline = None
+
+    # When we run out of file descriptors, pending connections stay in the listen queue and
+    # keep the server readable, so we stop watching it for a while instead of spinning.
+    resume_accepting = None
+
+    def pause_accepting(err: OSError) -> None:
+        nonlocal resume_accepting
+        log.info("Cannot accept connection, pausing: %s", err)
+        sel.unregister(server)
+        resume_accepting = time.monotonic() + ACCEPT_BACKOFF
+
+    try:
+        while True:
+            if shutdown_requested.is_set() and deadline is None:
+                log.info("Shutting down due to signal and deleting %s", socket_path)
+                if resume_accepting is None:
+                    sel.unregister(server)
+                resume_accepting = None
+                server.close()
+                socket_deleted.set()
+                try:
+                    os.unlink(socket_path)
+                except OSError:
+                    pass
+                deadline = time.monotonic() + SHUTDOWN_GRACE_PERIOD
+
+            timeout = None
+            if resume_accepting is not None:
+                timeout = resume_accepting - time.monotonic()
+                if timeout <= 0:
+                    sel.register(server, selectors.EVENT_READ, server)
+                    resume_accepting = None
+                    timeout = None
+            if deadline is not None:
+                if not connections and lookups == 0:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    for client_endpoint in list(connections):
+                        close_connection(sel, client_endpoint, Exception("shutting down"))
+                    # Skip the cleanup of the interpreter, which could otherwise block on whatever
+                    # held up the connections in the first place.
+                    log.info("Grace period expired; exiting")
+                    os._exit(1)
+
+            for key, mask in sel.select(timeout):
+                if key.data is server:
+                    while True:
+                        try:
+                            client, _ = server.accept()
+                        except BlockingIOError:
+                            break
+                        except OSError as err:
+                            if err.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                                                 errno.ENOMEM):
+                                raise
+                            pause_accepting(err)
+                            break
+                        log.info("Accepted client connection")
+                        tune_socket(client)
+                        pending.put(client)
+                        lookups += 1
+
+                elif key.data is signal_r:
+                    # The signal handlers have already run by the time we get here, so there is
+                    # nothing to do other than to consume the wakeup.
+                    try:
+                        while os.read(signal_r, BUF_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+
+                elif key.data is wakeup_r:
+                    try:
+                        while wakeup_r.recv(BUF_SIZE):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    while not found.empty():
+                        client, agent = found.get()
+                        if isinstance(agent, Exception):
+                            log.info("Agent lookup failed: %s", agent)
+                            agent = None
+                        lookups -= 1
+                        client_endpoint = handle_connection(sel, client, agent)
+                        if client_endpoint is not None:
+                            connections.add(client_endpoint)
+                        elif resume_accepting is not None:
+                            # Dropping the client freed a file descriptor, so try again.
+                            resume_accepting = time.monotonic()
+
+                else:
+                    endpoint = key.data
+                    if endpoint.events == 0:
+                        # The connection was closed while handling an earlier event in this
+                        # same batch.
+                        continue
+                    done, err = proxy_connection(sel, endpoint, mask)
+                    if done:
+                        close_connection(sel, endpoint, err)
+                        connections.discard(endpoint)
+                        connections.discard(endpoint.peer)
+                        if resume_accepting is not None:
+                            # The connection freed some file descriptors, so try again.
+                            resume_accepting = time.monotonic()
+    finally:
+        signal.set_wakeup_fd(old_wakeup_fd)
+        sel.close()
+        wakeup_r.close()
+        wakeup_w.close()
+        os.close(signal_r)
+        os.close(signal_w)
 
 
 def run_server(args) -> None:
     if not args.socketPath:
-        logging.error("socketPath is empty")
+        log.error("socketPath is empty")
         sys.exit(1)
-    
-    # Configure logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(levelname)s: %(message)s'  # Match Go's log format
-    )
 
     # Install signal handlers before we create the socket so that we don't leave it
     # behind in any case.
@@ -247,25 +783,18 @@ def run_server(args) -> None:
 
         server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         server.bind(args.socketPath)
-        server.listen(5)
-        logging.info(f"Listening on {args.socketPath}")
-        
-        while True:
-            client, _ = server.accept()
-            # Use a thread for each connection to match Go's goroutines
-            thread = threading.Thread(
-                target=connection_handler_thread,
-                args=(client, args.agentsDir),
-                daemon=True
-            )
-            thread.start()
-            
-    except KeyboardInterrupt:
-        logging.info(f"Shutting down and deleting {args.socketPath}")
-        try:
-            os.unlink(args.socketPath)
-        except OSError:
-            pass
+        # Allow for bursts of connections, such as when many terminals or editor windows
+        # reconnect at once, instead of having the kernel refuse them.
+        server.listen(socket.SOMAXCONN)
+        log.info("Listening on %s", args.socketPath)
+        if not HAVE_SPLICE:
+            log.info("Splicing not available; copying data through buffers")
+
+        serve(server, args.socketPath, make_agent_finder(args.agentsDir))
+
+        # We only return from serving when a signal asks us to exit.
+        sys.exit(1)
+
     finally:
         # Restore the original umask
         os.umask(old_umask)
@@ -329,6 +858,11 @@ def main() -> None:
         default="/tmp",
         help="directory where to look for running agents"
     )
+    parser.add_argument(
+        "--debug",
+        action='store_true',default=False,
+        help="also log why candidate agent sockets are ignored"
+    )
     parser.epilog='''
     This script fixes agent forwarding under tmux.
 
@@ -343,10 +877,16 @@ def main() -> None:
     '''
     
     args = parser.parse_args()
+
+    # Configure logging before anything can report an error
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(levelname)s: %(message)s'  # Match Go's log format
+    )
     
     # No positional arguments allowed
     if len(sys.argv) > 1 and sys.argv[1][0] != '-':
-        logging.error("No positional arguments allowed")
+        log.error("No positional arguments allowed")
         sys.exit(1)
 
     if args.install:
@@ -91,7 +91,7 @@ echo "  ssh-add -l test passed"
 if ! grep -q "Successfully opened SSH agent at $AGENT_SOCK" switcher.log; then
   echo "ERROR: Log does not contain expected 'Successfully opened' message"
   cat switcher.log
-  kill $SWITCHER_PID
+  kill $SWITCHER_PID 2>/dev/null || true  # The daemon may have exited already.
   . agent.env
   kill $SSH_AGENT_PID
   rm -rf "$SOCKETS_ROOT"
@@ -99,9 +99,139 @@ if ! grep -q "Successfully opened SSH agent at $AGENT_SOCK" switcher.log; then
 fi
 
 echo "  Log contains expected agent connection message"
+kill $SWITCHER_PID
+sleep 1  # Wait for cleanup
 
-# Clean up
+# Test 4: Proxying with splicing disabled
+echo "Test 4: Testing the copy fallback with splicing disabled..."
+SSH_AGENT_SWITCHER_NO_SPLICE=1 \
+  ./ssh_agent_switcher.py --socketPath "$SWITCHER_SOCK" --agentsDir "$SOCKETS_ROOT" 2>switcher.log &
+SWITCHER_PID=$!
+sleep 1
+
+fail() {
+  echo "ERROR: $1"
+  cat switcher.log
+  kill $SWITCHER_PID 2>/dev/null || true  # The daemon may have exited already.
+  . agent.env
+  kill $SSH_AGENT_PID
+  rm -rf "$SOCKETS_ROOT"
+  exit 1
+}
+
+grep -q "copying data through buffers" switcher.log || fail "Splicing was not disabled"
+
+# A 4096-bit key does not fit in a single read, so adding it takes multiple copies.
+ssh-keygen -q -t rsa -b 4096 -N '' -f "${SOCKETS_ROOT}/id_rsa" >/dev/null
+ssh-add "${SOCKETS_ROOT}/id_rsa" >/dev/null 2>&1 || fail "ssh-add of a key failed"
+echo "  ssh-add of a large key passed"
+
+# Run more connections at once than the buffer pool keeps so that their buffers are both
+# reused and dropped when they close.
+PIDS=""
+for i in $(seq 1 50); do
+  ssh-add -L >"${SOCKETS_ROOT}/out.$i" 2>&1 &
+  PIDS="$PIDS $!"
+done
+wait $PIDS || fail "Concurrent ssh-add -L failed"
+for i in $(seq 1 50); do
+  grep -q "^ssh-rsa" "${SOCKETS_ROOT}/out.$i" || fail "Concurrent ssh-add -L returned no key"
+done
+echo "  Concurrent ssh-add -L passed"
+
+python3 - <<'EOF2' || fail "BufferPool test failed"
+import ssh_agent_switcher as s
+
+pool = s.BufferPool(16, 2)
+a, b, c = pool.acquire(), pool.acquire(), pool.acquire()
+assert len(a) == len(b) == len(c) == 16
+pool.release(bytearray(8))  # Buffers of the wrong size are dropped.
+assert pool.free.empty()
+pool.release(a)
+pool.release(b)
+pool.release(c)  # The pool is full, so this is dropped.
+assert pool.acquire() is b
+assert pool.acquire() is a
+d = pool.acquire()
+assert d is not a and d is not b and d is not c
+EOF2
+echo "  BufferPool test passed"
 kill $SWITCHER_PID
+sleep 1  # Wait for cleanup
+
+# Test 5: Graceful shutdown
+echo "Test 5: Testing graceful shutdown..."
+./ssh_agent_switcher.py --socketPath "$SWITCHER_SOCK" --agentsDir "$SOCKETS_ROOT" 2>switcher.log &
+SWITCHER_PID=$!
+sleep 1
+
+# Open a connection, ask the daemon to shut down, and then make sure that the socket is gone
+# right away, that the connection still works, and that the daemon exits once the grace period
+# expires even though the client never closes its connection.
+python3 - "$SWITCHER_SOCK" "$SWITCHER_PID" <<'EOF2' || fail "Graceful shutdown test failed"
+import os, signal, socket, struct, sys, time
+
+path, pid = sys.argv[1], int(sys.argv[2])
+conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+conn.connect(path)
+time.sleep(0.5)  # Let the daemon find the agent.
+
+start = time.monotonic()
+os.kill(pid, signal.SIGTERM)
+time.sleep(0.5)
+assert not os.path.exists(path), "socket not deleted"
+
+# SSH_AGENTC_REQUEST_IDENTITIES, answered with SSH_AGENT_IDENTITIES_ANSWER.
+conn.sendall(struct.pack(">IB", 1, 11))
+length, = struct.unpack(">I", conn.recv(4, socket.MSG_WAITALL))
+reply = conn.recv(length, socket.MSG_WAITALL)
+assert reply[0] == 12, "unexpected reply %r" % reply
+
+while True:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        break
+    assert time.monotonic() - start < 10, "daemon did not exit"
+    time.sleep(0.1)
+assert time.monotonic() - start >= 4, "daemon exited before the grace period expired"
+EOF2
+grep -q "Grace period expired" switcher.log || fail "Log does not mention the grace period"
+echo "  Graceful shutdown test passed"
+
+# A second signal makes the daemon exit right away.  By then the daemon has deleted its socket
+# and a new daemon may be listening at the same path, so make sure it is left alone.
+echo "  Testing a repeated signal with a new daemon running..."
+./ssh_agent_switcher.py --socketPath "$SWITCHER_SOCK" --agentsDir "$SOCKETS_ROOT" 2>switcher.log &
+SWITCHER_PID=$!
+sleep 1
+python3 -c 'import socket, sys, time
+conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+conn.connect(sys.argv[1])
+time.sleep(10)' "$SWITCHER_SOCK" &
+HOLDER_PID=$!
+sleep 0.5
+OLD_PID=$SWITCHER_PID
+kill -TERM $OLD_PID
+sleep 0.5
+[ ! -e "$SWITCHER_SOCK" ] || fail "Socket not deleted on the first signal"
+
+./ssh_agent_switcher.py --socketPath "$SWITCHER_SOCK" --agentsDir "$SOCKETS_ROOT" 2>switcher2.log &
+SWITCHER_PID=$!
+sleep 1
+kill -INT $OLD_PID
+sleep 0.5
+if kill -0 $OLD_PID 2>/dev/null; then
+  kill $OLD_PID
+  fail "Daemon did not exit on the second signal"
+fi
+[ -e "$SWITCHER_SOCK" ] || fail "Second signal deleted the socket of the new daemon"
+echo "  Repeated signal test passed"
+kill $SWITCHER_PID
+kill $HOLDER_PID
+rm -f switcher2.log
+
+# Clean up
 . agent.env
 kill $SSH_AGENT_PID
 rm -rf "$SOCKETS_ROOT"